@@ -108,7 +108,7 @@ xwzy = sim.get_array_metadata(vol=vol)
 print(xwzy[0])
 #quit()
 my_grid = mpa.xyzw2grid(xwzy)
-pts = np.array([[v.x,v.y,v.z] for v in my_grid.points])
+pts = np.asarray(my_grid.points)
 
 M = mpa.make_interpolation_matrix(pts,basis.fs)
 
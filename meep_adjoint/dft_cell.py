@@ -9,10 +9,16 @@
    to describe sets of frequency-domain field components.
 """
 
+import os
+import hashlib
+import zipfile
 import numpy as np
 import meep as mp
 import warnings
 from collections import namedtuple
+from functools import lru_cache
+
+from . import _kernels
 
 ######################################################################
 # general-purpose constants and utility routines
@@ -25,23 +31,39 @@ EH_CPTS          = E_CPTS + H_CPTS
 EH_TRANSVERSE    = [ [mp.Ey, mp.Ez, mp.Hy, mp.Hz],
                      [mp.Ez, mp.Ex, mp.Hz, mp.Hx],
                      [mp.Ex, mp.Ey, mp.Hx, mp.Hy] ]
+_NO_IDX          = np.zeros(0, dtype=np.intp)
+
+# on-disk location for cached eigenmode slices (see DFTCell.get_eigenmode_slices);
+# disk caching is opt-in, so this is None unless MEEP_ADJOINT_EIGEN_CACHE is set
+EIGEN_CACHE_DIR  = os.environ.get('MEEP_ADJOINT_EIGEN_CACHE')
 
 ######################################################################
 # fix a bug in libmeep
 ######################################################################
 def fix_array_metadata(xyzw, center, size):
     """fixes for the perenially buggy get_array_metadata routine in core meep."""
+    center = np.array([center[d] for d in range(3)], dtype=np.float64)
+    size   = np.array([size[d] for d in range(3)], dtype=np.float64)
+    collapsed = [ size[d]==0.0 and xyzw[d][0]!=center[d] for d in range(3) ]
     for d in range(0,3):
-        if size[d]==0.0 and xyzw[d][0]!=center[d]:
-            xyzw[d]=np.array([center[d]])
-        else:
-            xyzw[d]=np.array(xyzw[d])
+        xyzw[d] = center[d:d+1] if collapsed[d] else np.asarray(xyzw[d])
 
 
 ######################################################################
 # 'Grid' is a convenience extension of 'array metadata'
 ######################################################################
-Grid = namedtuple('Grid', ['xtics', 'ytics', 'ztics', 'points', 'weights', 'shape'])
+class Grid(namedtuple('Grid', ['xtics', 'ytics', 'ztics', 'points', 'weights', 'shape'])):
+    """Grid tics, points and quadrature weights for a subregion.
+
+    ``points`` is an (N,3) array of coordinates; use ``points_as_vec3``
+    where ``mp.Vector3`` instances are required.
+    """
+    __slots__ = ()
+
+    @property
+    def points_as_vec3(self):
+        """Iterator over grid points as mp.Vector3, constructed lazily."""
+        return (mp.Vector3(*p) for p in self.points)
 
 def make_grid(size, center=np.zeros(3), dims=None, length=None):
     """Construct a Grid for a rectangular subregion.
@@ -59,9 +81,22 @@ def make_grid(size, center=np.zeros(3), dims=None, length=None):
 
     Returns
     -------
-    New instance of Grid.
+    Grid
+        Grids are memoized on their geometry, so the returned instance (whose
+        arrays are read-only) may be shared with other callers.
     """
+    return _make_grid(tuple(float(s) for s in size), tuple(float(c) for c in center),
+                      None if dims is None else tuple(int(n) for n in dims), length)
+
+
+def _read_only(a):
+    a = np.asarray(a, dtype=np.float64)
+    a.setflags(write=False)
+    return a
 
+
+@lru_cache(maxsize=128)
+def _make_grid(size, center, dims, length):
     nd = len(np.flatnonzero(size))
     center, size = np.array(center)[0:nd], np.array(size)[0:nd]
     if length is not None:
@@ -72,18 +107,29 @@ def make_grid(size, center=np.zeros(3), dims=None, length=None):
     tics = [np.linspace(a, b, n) for (a, b, n) in zip(pmin, pmax, dims)]
     if len(tics)==2:
         tics.append([0])
-    points = [np.array([x, y, z]) for x in tics[0] for y in tics[1] for z in tics[2] ]
+    tics = [_read_only(t) for t in tics]
+    points = np.stack(np.meshgrid(*tics, indexing='ij'), axis=-1).reshape(-1,3)
     vol, ntot = np.prod([s for s in size if s>0]), np.prod(dims)
     weights = (vol/ntot) * np.ones(ntot)
-    shape = [len(t) for t in tics if len(t)>1]
-    return Grid(tics[0], tics[1], tics[2], points, weights, shape)
+    shape = tuple(len(t) for t in tics if len(t)>1)
+    return Grid(tics[0], tics[1], tics[2], _read_only(points), _read_only(weights), shape)
 
 
 def xyzw2grid(xyzw):
-    """Construct Grid from lists of points and weights."""
-    return Grid(xyzw[0], xyzw[1], xyzw[2],
-                [mp.Vector3(x,y,z) for x in xyzw[0] for y in xyzw[1] for z in xyzw[2]],
-                 xyzw[3].flatten(), xyzw[3].shape)
+    """Construct Grid from lists of points and weights.
+
+    Grids are memoized on the contents of xyzw, so the returned instance
+    (whose arrays are read-only) may be shared with other callers.
+    """
+    x, y, z, w = [np.asarray(a, dtype=np.float64) for a in xyzw]
+    return _xyzw2grid(x.tobytes(), y.tobytes(), z.tobytes(), w.shape, w.tobytes())
+
+
+@lru_cache(maxsize=128)
+def _xyzw2grid(xb, yb, zb, wshape, wb):
+    x, y, z, w = [np.frombuffer(b, dtype=np.float64) for b in (xb, yb, zb, wb)]
+    points = np.stack(np.meshgrid(x, y, z, indexing='ij'), axis=-1).reshape(-1,3)
+    return Grid(x, y, z, _read_only(points), w, wshape)
 
 
 class Subregion(object):
@@ -165,8 +211,11 @@ class DFTCell(object):
        to save an internally cached snapshot of the fields computed on a
        given timestepping run.
 
-       Note: for now, all arrays are stored in memory. For large calculations with
-       many DFT frequencies it might make sense to implement a disk-caching scheme.
+       Note: for now, all DFT field arrays are stored in memory. For large
+       calculations with many DFT frequencies it might make sense to implement
+       a disk-caching scheme. Eigenmode slices, which depend only on the
+       structure and not on the fields, may additionally be cached on disk
+       (see ``eigen_cache_dir``) so they survive across processes.
 
        The internally-stored frequency-domain fields at a single frequency
        may be fetched via the get_EH_slice (single component) or
@@ -196,15 +245,30 @@ class DFTCell(object):
            Field components to compute.
        fcen, df, nfreq: float, float, int
            Set of frequencies at which to compute FD fields.
+       single_precision : bool, optional
+           Store fields archived by ``save_fields`` as complex64 rather
+           than complex128, by default False. The ``'incident'`` archive
+           is always kept in complex128, since scattered-field quantities
+           subtract it from the total fields. (The DFT registers accumulated
+           during timestepping are allocated by core meep and are not
+           affected.)
+       eigen_cache_dir : str or None, optional
+           Directory in which computed eigenmode slices are cached across runs,
+           by default ``EIGEN_CACHE_DIR`` (the MEEP_ADJOINT_EIGEN_CACHE
+           environment variable, or None to disable disk caching).
     """
-    def __init__(self, region, components=None):
+    def __init__(self, region, components=None, single_precision=False, eigen_cache_dir=EIGEN_CACHE_DIR):
         self.region     = region
+        self.single_precision = single_precision
+        self.eigen_cache_dir  = eigen_cache_dir
         self.normal     = region.normal
         self.celltype   = 'flux' if self.normal is not None else 'fields'
         self.components = components or (EH_TRANSVERSE[self.normal] if self.normal is not None else EH_CPTS)
         self.fcen       = 1/1.55#region.fcen
         self.df         = 0# region.df
         self.nfreq      = 1# region.nfreq
+        self._e_idx     = np.array([nc for nc,c in enumerate(self.components) if c in E_CPTS], dtype=np.intp)
+        self._h_idx     = np.array([nc for nc,c in enumerate(self.components) if c in H_CPTS], dtype=np.intp)
         self.freqs      = [self.fcen] if self.nfreq==1 else np.linspace(self.fcen-0.5*self.df, self.fcen+0.5*self.df, self.nfreq)
 
         self.sim        = None  # mp.simulation for current simulation
@@ -212,6 +276,8 @@ class DFTCell(object):
 
         self.EH_cache   = {}    # cache of frequency-domain field data computed in previous simulations
         self.eigencache = {}    # cache of eigenmode field data to avoid redundant recalculations
+        self._eps_cache = {}    # per-frequency material arrays for the current simulation
+        self._mu_cache  = {}
 
         global dft_cell_names
         if region.name is not None:
@@ -230,6 +296,7 @@ class DFTCell(object):
         # and thus logically belongs in `vec.cpp` or another code module that
         # exists independently of fields, structures, etc.
         self.grid = None
+        self._w_flat = None  # flattened quadrature weights, set once grid is known
 
 
 
@@ -241,6 +308,7 @@ class DFTCell(object):
         sim : mp.Simulation
         """
         self.sim = sim
+        self._eps_cache, self._mu_cache = {}, {}
         if self.celltype == 'flux':
             flux_region  = mp.FluxRegion(self.region.center,self.region.size,direction=self.normal)
             self.dft_obj = sim.add_flux(self.fcen,self.df,self.nfreq,flux_region)
@@ -252,6 +320,8 @@ class DFTCell(object):
             xyzw=sim.get_array_metadata(center=self.region.center, size=self.region.size, collapse=True, snap=True)
             fix_array_metadata(xyzw, self.region.center, self.region.size)
             self.grid = xyzw2grid(xyzw)
+            self._w_flat = np.ascontiguousarray(self.grid.weights.ravel(), dtype=np.float64)
+            self._w_flat.setflags(write=False)  # matches the signature _kernels._warmup compiles
 
     ######################################################################
     ######################################################################
@@ -287,8 +357,8 @@ class DFTCell(object):
     def get_EH_slices(self, label=None, nf=0):
         """Fetch arrays of frequency-domain field amplitudes for all stored components.
 
-        Return a 1D array (list) of arrays of frequency-domain field amplitudes,
-        one for each component in this DFTCell, at a single frequency in a
+        Return an array of frequency-domain field amplitudes, whose leading
+        index runs over the components in this DFTCell, at a single frequency in a
         single MEEP simulation. The simulation in question may be the present,
         ongoing simulation (if label==None), in which case the array slices are
         read directly from the currently active meep DFT object; or it may be a
@@ -304,8 +374,8 @@ class DFTCell(object):
 
         Returns
         -------
-        list of np.array
-            Arrays of field-component amplitudes at grid points
+        np.array
+            Array of shape (ncomp,) + grid.shape of field-component amplitudes at grid points
 
         Raises
         ------
@@ -313,7 +383,7 @@ class DFTCell(object):
             if no data exists for the specified label.
         """
         if label is None:
-            return [ self.get_EH_slice(c, nf=nf) for c in self.components ]
+            return np.stack([ self.get_EH_slice(c, nf=nf) for c in self.components ])
         elif label in self.EH_cache:
             return self.EH_cache[label][nf]
         raise ValueError("DFTCell {} has no saved data for label '{}'".format(self.name, label))
@@ -324,14 +394,12 @@ class DFTCell(object):
 
         Parameters
         ----------
-        EHT : list of arrays of field component amplitudes, as
-              returned by get_EH_slices, for the **total** fields
+        EHT : array of field component amplitudes, as returned
+              by get_EH_slices, for the **total** fields; modified in place
         nf : int, optional
              frequency index, by default 0
         """
-        EHI = self.get_EH_slices(label='incident', nf=nf)
-        for nc, c in enumerate(self.components):
-            EHT[nc] -= EHI[nc]
+        EHT -= self.get_EH_slices(label='incident', nf=nf)
 
 
     def save_fields(self, label):
@@ -349,8 +417,21 @@ class DFTCell(object):
         ----------
         label : str
             Label assigned to data set, used subsequently for retrieval.
+
+        Note
+        ----
+        If the cell was created with ``single_precision=True``, saved fields
+        other than the ``'incident'`` archive are stored as complex64, which
+        halves the memory footprint. The incident fields stay in complex128:
+        subtracting a complex64 copy from the total fields would leave an
+        error floor of ~1e-7 times the incident amplitude on every
+        scattered-field quantity.
         """
-        self.EH_cache[label] = [self.get_EH_slices(nf=nf) for nf in range(len(self.freqs))]
+        dtype = np.complex64 if self.single_precision and label!='incident' else np.complex128
+        buf = np.empty((len(self.freqs), len(self.components)) + tuple(self.grid.shape), dtype=dtype)
+        for nf in range(len(self.freqs)):
+            buf[nf] = self.get_EH_slices(nf=nf)
+        self.EH_cache[label] = buf
 
 
     def get_eigenmode_slices(self, mode, nf=0):
@@ -378,23 +459,85 @@ class DFTCell(object):
         if self.eigencache and tag in self.eigencache:
             return self.eigencache[tag]
 
-        # data not in cache; compute eigenmode and populate slice arrays
+        # look for data in disk cache
         freq, dir, k0 = self.freqs[nf], self.normal, mp.Vector3()
+        fname = self._eigencache_file(mode, freq)
+        eh_slices = self._load_eigencache_file(fname) if fname is not None else None
+        if eh_slices is not None:
+            self.eigencache[tag]=eh_slices
+            return eh_slices
+
+        # data not in cache; compute eigenmode and populate slice arrays
         vol = mp.Volume(center=self.region.center,size=self.region.size)
         eigenmode = self.sim.get_eigenmode(freq, dir, vol, mode, k0)
 
-        def get_eigenslice(eigenmode, grid, c):
-            return np.reshape( [eigenmode.amplitude(p,c) for p in grid.points], grid.shape )
+        # build the Vector3 evaluation points once and reuse them for all components
+        pts = list(self.grid.points_as_vec3)
+        def get_eigenslice(eigenmode, c):
+            amps = np.fromiter((eigenmode.amplitude(p,c) for p in pts), dtype=np.complex128, count=len(pts))
+            return amps.reshape(self.grid.shape)
 
-        eh_slices=[get_eigenslice(eigenmode,self.grid,c) for c in self.components]
+        eh_slices=[get_eigenslice(eigenmode,c) for c in self.components]
 
-        # store in cache before returning
+        # store in caches before returning
         if self.eigencache is not None:
             self.eigencache[tag]=eh_slices
+        if fname is not None and mp.am_master():
+            os.makedirs(self.eigen_cache_dir, exist_ok=True)
+            tmp = '{}.{}.tmp.npz'.format(fname[:-4], os.getpid())
+            np.savez_compressed(tmp, *eh_slices)
+            os.replace(tmp, fname)
 
         return eh_slices
 
 
+    def _eigencache_file(self, mode, freq):
+        """Path of the disk-cache file for eigenmode slices, or None if disabled.
+
+        The key covers everything the eigenmode profile depends on: the grid
+        points, field components, normal direction, resolution, frequency,
+        mode index, and the permittivity and permeability over the cell
+        cross-section.
+        """
+        if not self.eigen_cache_dir:
+            return None
+        eps, mu = [self.sim.get_array(center=self.region.center, size=self.region.size, component=c)
+                   for c in (mp.Dielectric, mp.Permeability)]
+        key = hashlib.sha1()
+        for item in (self.grid.points, np.asarray(eps, dtype=np.float64), np.asarray(mu, dtype=np.float64),
+                     self.grid.shape, self.components, self.normal, self.sim.resolution, freq, mode):
+            key.update(item.tobytes() if isinstance(item, np.ndarray) else repr(item).encode())
+        return os.path.join(self.eigen_cache_dir, key.hexdigest() + '.npz')
+
+
+    def _load_eigencache_file(self, fname):
+        """Eigenmode slices read from the disk cache, or None on a cache miss.
+
+        Every process must reach the same verdict, since on a miss they all
+        go on to the collective sim.get_eigenmode; a process that skipped it
+        would leave the others waiting forever. Processes may see different
+        things on a shared or NFS filesystem, or while another job is writing
+        the file, so under MPI the verdict is agreed collectively: it is a hit
+        only if every process, the master included, read the file.
+        """
+        try:
+            with np.load(fname) as data:
+                eh_slices = [data['arr_{}'.format(n)] for n in range(len(self.components))]
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile): # missing or unreadable
+            eh_slices = None
+        if mp.count_processors() > 1 and not mp.and_to_all(eh_slices is not None):
+            eh_slices = None
+        return eh_slices
+
+
+    def _material_slice(self, cache, c, nf):
+        """Flattened Dielectric/Permeability array at frequency nf, fetched once per simulation."""
+        if nf not in cache:
+            F = self.sim.get_dft_array(self.dft_obj, c, nf)
+            cache[nf] = np.ascontiguousarray(np.ravel(F), dtype=np.complex128)
+        return cache[nf]
+
+
     def __call__(self, qcode, mode=1, nf=0):
         """Compute and return the value of an objective quantity.
 
@@ -415,49 +558,50 @@ class DFTCell(object):
         float64 or complex128
             value of objective quantity
         """
-        w  = np.reshape(self.grid.weights,self.grid.shape)
+        handler = _HANDLERS.get(qcode.upper())
+        if handler is None: # TODO: support other types of objectives quantities?
+            raise ValueError('DFTCell {}: unsupported quantity type {}'.format(self.name,qcode))
         EH = self.get_EH_slices(nf=nf)
-        quantity=qcode.upper()
         if qcode.islower():
              self.subtract_incident_fields(EH,nf)
-        if quantity=='S':
-            return np.real(np.sum(w*( np.conj(EH[0])*EH[3] - np.conj(EH[1])*EH[2]) ))
-        if quantity.upper() in 'PFMB':
-            eh = self.get_eigenmode_slices(mode, nf)  # EHList of eigenmode fields
-            eH = np.sum( w*(np.conj(eh[0])*EH[3] - np.conj(eh[1])*EH[2]) )
-            hE = np.sum( w*(np.conj(eh[3])*EH[0] - np.conj(eh[2])*EH[1]) )
-            
-            '''struct = self.sim.get_eigenmode_coefficients(self.dft_obj,[1])
-            alpha = struct.alpha
-            direction = 0 if quantity.upper() in 'PF' else 1
-            mode_coeff = alpha[mode-1,nf,direction]
-            print(mode_coeff)
-            return mode_coeff
-            print(alpha.shape)
-            #print('Final time: ',self.sim.meep_time())
-            quit()'''
-
-            sign=1.0 if qcode in ['P','F'] else -1.0
-            '''print('Final time: ',self.sim.round_time())
-            temp = (eH + sign*hE)/4.0
-            print(EH[0][0])
-            print(eh[0][0])
-            quit()'''
-            #print((eH + sign*hE)/4.0)
-            return (eH + sign*hE)/4.0
-        if quantity in ['UE', 'UH', 'UM', 'UEH', 'UEM', 'UT']:
-           q=0.0
-           if quantity in ['UE', 'UEH', 'UEM', 'UT']:
-               eps = self.sim.get_dft_array(self.dft_obj, mp.Dielectric, nf)
-               E2  = np.sum( [np.conj(EH[nc])*EH[nc] for nc,c in enumerate(self.components) if c in E_CPTS], axis=0 )
-               q  += 0.5*np.sum(w*eps*E2)
-           if quantity in ['UH', 'UM', 'UEH', 'UEM', 'UT']:
-               mu  = self.sim.get_dft_array(self.dft_obj, mp.Permeability, nf)
-               H2  = np.sum( [np.conj(EH[nc])*EH[nc] for nc,c in enumerate(self.components) if c in H_CPTS], axis=0 )
-               q  += 0.5*np.sum(w*mu*H2)
-           return q
-        else: # TODO: support other types of objectives quantities?
-            ValueError('DFTCell {}: unsupported quantity type {}'.format(self.name,qcode))
+
+        # flattened, contiguous arrays for the compiled reduction kernels
+        EHf = [np.ascontiguousarray(np.ravel(F), dtype=np.complex128) for F in EH]
+        return handler(self, qcode.upper(), EHf, mode, nf)
+
+
+######################################################################
+# handlers for the objective quantities computed by DFTCell.__call__,
+# indexed by (upper-case) quantity code. Each takes the cell, the
+# quantity code, the list of flattened field arrays, the eigenmode
+# index, and the frequency index.
+######################################################################
+def _flux_handler(cell, quantity, EHf, mode, nf):
+    return _kernels.poynting(cell._w_flat, *EHf[0:4])
+
+
+def _overlap_handler(cell, quantity, EHf, mode, nf):
+    eh = [np.ascontiguousarray(np.ravel(F), dtype=np.complex128)
+          for F in cell.get_eigenmode_slices(mode, nf)]  # EHList of eigenmode fields
+    sign=1.0 if quantity in ['P','F'] else -1.0
+    return _kernels.overlap(cell._w_flat, *eh[0:4], *EHf[0:4], sign)
+
+
+def _energy_handler(cell, quantity, EHf, mode, nf):
+    zero = np.zeros(cell._w_flat.size, dtype=np.complex128)
+    eps, mu, e_idx, h_idx = zero, zero, _NO_IDX, _NO_IDX
+    if quantity in ['UE', 'UEH', 'UEM', 'UT']:
+        eps = cell._material_slice(cell._eps_cache, mp.Dielectric, nf)
+        e_idx = cell._e_idx
+    if quantity in ['UH', 'UM', 'UEH', 'UEM', 'UT']:
+        mu  = cell._material_slice(cell._mu_cache, mp.Permeability, nf)
+        h_idx = cell._h_idx
+    return _kernels.energy(cell._w_flat, eps, mu, np.stack(EHf), e_idx, h_idx)
+
+
+_HANDLERS = { 'S': _flux_handler,
+              **{q: _overlap_handler for q in ['P', 'F', 'M', 'B']},
+              **{q: _energy_handler for q in ['UE', 'UH', 'UM', 'UEH', 'UEM', 'UT']} }
 
 
 ######################################################################
@@ -480,8 +624,17 @@ def rescale_sources(sources):
        Returns:
            none (the rescaling is done in-place)
     """
+    # sources commonly share a single envelope object, so evaluate each
+    # distinct envelope's transform (and probe each envelope type) only once
+    has_ft, T = {}, {}
     for s in sources:
-        envelope, fcen = s.src, s.src.frequency
-        if callable(getattr(envelope, "fourier_transform", None)):
-            s.amplitude /= envelope.fourier_transform(fcen)
+        envelope = s.src
+        kind = type(envelope)
+        if kind not in has_ft:
+            has_ft[kind] = callable(getattr(envelope, "fourier_transform", None))
+        if not has_ft[kind]:
+            continue
+        if id(envelope) not in T:
+            T[id(envelope)] = envelope.fourier_transform(envelope.frequency)
+        s.amplitude /= T[id(envelope)]
 
@@ -113,7 +113,7 @@ class FiniteElementBasis(Basis):
     def deps_dp(self,eps,grid):
         # get array of grid points that correspond to epsilon vector
         eps = eps.flatten()
-        pts = np.array([[v.x,v.y,v.z] for v in grid.points])
+        pts = np.asarray(grid.points)
         M = make_interpolation_matrix(pts, self.fs)
         return  eps * M
     
@@ -1,11 +1,24 @@
 """Handling of objective functions and objective quantities."""
 
 from abc import ABC, abstractmethod
+from functools import lru_cache
 import numpy as np
 import meep as mp
 from .filter_source import FilteredSource
 from matplotlib import pyplot as plt
 
+@lru_cache(maxsize=64)
+def _fourier_transform(time_src, freqs):
+    '''Fourier transform of the envelope of time_src at each frequency in the tuple freqs.
+
+    Memoized so that repeated adjoint runs with the same source and frequency
+    grid skip the per-frequency calls into libmeep. The cache holds a reference
+    to time_src, so keys cannot be recycled by a different source object.
+    '''
+    T = np.array([time_src.fourier_transform(f) for f in freqs])
+    T.setflags(write=False)
+    return T
+
 class ObjectiveQuantitiy(ABC):
     @abstractmethod
     def __init__(self):
@@ -24,10 +37,14 @@ class ObjectiveQuantitiy(ABC):
         return
 
 class EigenmodeCoefficient(ObjectiveQuantitiy):
-    def __init__(self,sim,volume,mode,forward=True,k0=None,**kwargs):
+    def __init__(self,sim,volume,mode,forward=True,k0=None,decimation_factor=0,**kwargs):
         '''
+        decimation_factor ... if nonzero, update the monitor's DFT fields only every
+                              decimation_factor timesteps (requires meep >= 1.20);
+                              must be small enough to resolve the source bandwidth
         '''
         self.sim = sim
+        self.decimation_factor = decimation_factor
         self.volume=volume
         self.mode=mode
         self.forward = 0 if forward else 1
@@ -42,7 +59,8 @@ class EigenmodeCoefficient(ObjectiveQuantitiy):
         self.df=df
         self.nf=nf
 
-        self.monitor = self.sim.add_mode_monitor(self.fcen,self.df,self.nf,mp.FluxRegion(center=self.volume.center,size=self.volume.size))
+        monitor_kwargs = {'decimation_factor': self.decimation_factor} if self.decimation_factor else {}
+        self.monitor = self.sim.add_mode_monitor(self.fcen,self.df,self.nf,mp.FluxRegion(center=self.volume.center,size=self.volume.size),**monitor_kwargs)
         self.normal_direction = self.monitor.normal_direction
         return self.monitor
     
@@ -81,7 +99,7 @@ class EigenmodeCoefficient(ObjectiveQuantitiy):
         else:
             dV = 1/self.sim.resolution * 1/self.sim.resolution * 1/self.sim.resolution
         da_dE = 0.5*(dV * self.cscale)
-        scale = da_dE * dJ * 1j * 2 * np.pi * self.freqs / np.array([self.time_src.fourier_transform(f) for f in self.freqs]) # final scale factor
+        scale = da_dE * dJ * 1j * 2 * np.pi * self.freqs / _fourier_transform(self.time_src, tuple(self.freqs)) # final scale factor
         if self.freqs.size == 1:
             # Single frequency simulations. We need to drive it with a time profile.
             src = self.time_src
@@ -1,7 +1,7 @@
 import meep as mp
 import numpy as np
 import autograd.numpy as npa
-from autograd import grad, jacobian
+from autograd import grad, make_vjp
 from collections import namedtuple
 
 Grid = namedtuple('Grid', ['x', 'y', 'z', 'w'])
@@ -32,7 +32,8 @@ class OptimizationProblem(object):
                 nf=1,
                 decay_dt=50,
                 decay_fields=[mp.Ez],
-                decay_by=1e-6
+                decay_by=1e-6,
+                maximum_run_time=None
                  ):
 
         self.sim = simulation
@@ -52,6 +53,7 @@ class OptimizationProblem(object):
         self.decay_by=decay_by
         self.decay_fields=decay_fields
         self.decay_dt=decay_dt
+        self.maximum_run_time=maximum_run_time # optional upper bound on the simulation time of each run
 
         self.num_design_params = [ni.num_design_params for ni in self.basis]
         
@@ -140,7 +142,7 @@ class OptimizationProblem(object):
         mdft = self.sim.add_dft_fields(self.decay_fields,self.fcen,self.df,1,center=self.design_regions[0].center,size=mp.Vector3(1/self.sim.resolution))
 
         # Forward run
-        self.sim.run(until_after_sources=stop_when_dft_decayed(mdft, self.decay_dt, self.decay_fields, self.fcen, self.decay_by))
+        self.sim.run(until_after_sources=self._stop_conditions(mdft))
 
         # record objective quantities from user specified monitors
         self.results_list = []
@@ -158,8 +160,9 @@ class OptimizationProblem(object):
                 for ic, c in enumerate([mp.Ex,mp.Ey,mp.Ez]):
                     self.d_E[nb][:,:,:,ic,f] = np.atleast_3d(self.sim.get_dft_array(dgm,c,f))
 
-        # store objective function evaluation in memory
+        # store objective function evaluation in memory, along with the design it belongs to
         self.f_bank.append(self.f0)
+        self.f0_rho = [np.array(b.rho_vector, dtype=float) for b in self.basis]
 
         # update solver's current state
         self.current_state = "FWD"
@@ -173,8 +176,8 @@ class OptimizationProblem(object):
 
         # Replace sources with adjoint sources
         self.adjoint_sources = []
-        for mi, m in enumerate(self.objective_arguments):
-            dJ = jacobian(self.objective_function,mi)(*self.results_list) # get gradient of objective w.r.t. monitor
+        dJ_list = objective_jacobians(self.objective_function,self.results_list) # get gradient of objective w.r.t. each monitor
+        for m, dJ in zip(self.objective_arguments, dJ_list):
             self.adjoint_sources.append(m.place_adjoint_source(dJ,self.dt)) # place the appropriate adjoint sources
         self.sim.change_sources(self.adjoint_sources)
 
@@ -186,7 +189,7 @@ class OptimizationProblem(object):
         mdft = self.sim.add_dft_fields(self.decay_fields,self.fcen,self.df,1,center=self.design_regions[0].center,size=mp.Vector3(1/self.sim.resolution))
 
         # Adjoint run
-        self.sim.run(until_after_sources=stop_when_dft_decayed(mdft, self.decay_dt, self.decay_fields, self.fcen, self.decay_by))
+        self.sim.run(until_after_sources=self._stop_conditions(mdft))
 
         # Store adjoint fields for each design basis in array (x,y,z,field_components,frequencies)
         # FIXME allow for multiple design regions
@@ -208,10 +211,25 @@ class OptimizationProblem(object):
         # Return optimizer's state to initialization
         self.current_state = "INIT"
     
-    def calculate_fd_gradient(self,num_gradients=1,db=1e-4,basis_idx=0):
+    def calculate_fd_gradient(self,num_gradients=1,db=1e-4,basis_idx=0,one_sided=False,fd_gradient_idx=None,f0=None):
         '''
-        Estimate central difference gradients.
+        Estimate finite-difference gradients.
+
+        By default central differences are used (two simulations per gradient
+        component). With one_sided=True, forward differences against a single
+        shared baseline simulation are used instead (one simulation per component
+        plus one), at the cost of O(db) rather than O(db^2) truncation error.
+        The baseline is f0 if given (e.g. the objective value for the current
+        design computed by another OptimizationProblem on the same grid); else
+        it is taken from the most recent forward_run if the design has not
+        changed since, and is simulated otherwise.
+
+        The design parameters to perturb are chosen at random unless given
+        explicitly as fd_gradient_idx, in which case num_gradients is ignored.
         '''
+        if fd_gradient_idx is not None:
+            fd_gradient_idx = np.atleast_1d(fd_gradient_idx)
+            num_gradients = fd_gradient_idx.size
 
         if num_gradients > self.num_design_params[basis_idx]:
             raise ValueError("The requested number of gradients must be less than or equal to the total number of design parameters.")
@@ -226,65 +244,87 @@ class OptimizationProblem(object):
         fd_gradient = 0*np.ones((self.num_design_params[basis_idx],num_outputs))
 
         # randomly choose indices to loop estimate
-        fd_gradient_idx = np.random.choice(self.num_design_params[basis_idx],num_gradients,replace=False)
+        if fd_gradient_idx is None:
+            fd_gradient_idx = np.random.choice(self.num_design_params[basis_idx],num_gradients,replace=False)
+
+        rho0 = np.array(self.basis[basis_idx].rho_vector, dtype=float)
+        if one_sided and f0 is None:
+            # reuse the most recent forward run as the baseline if the design is unchanged
+            rho_now = [np.array(b.rho_vector, dtype=float) for b in self.basis]
+            f0_rho = getattr(self, 'f0_rho', None)
+            if f0_rho is not None and all(np.array_equal(a, b) for a, b in zip(f0_rho, rho_now)):
+                f0 = self.f0
+            else:
+                f0 = self._evaluate_objective()
 
         for k in fd_gradient_idx:
-            
-            b0 = np.ones((self.num_design_params[basis_idx],))
-            b0[:] = self.basis[basis_idx].rho_vector
+            b0 = np.copy(rho0)
+
+            if one_sided:
+                b0[k] += db
+                self.basis[basis_idx].set_rho_vector(b0)
+                fp = self._evaluate_objective()
+                fd_gradient[k,:] = (fp - f0) / db
+                continue
+
             # -------------------------------------------- #
             # left function evaluation
             # -------------------------------------------- #
-            self.sim.reset_meep()
-            
-            # assign new design vector
             b0[k] -= db
             self.basis[basis_idx].set_rho_vector(b0)
-            
-            # initialize design monitors
-            for m in self.objective_arguments:
-                m.register_monitors(self.fcen,self.df,self.nf)
-            
-            # add monitor used to track dft convergence
-            mdft = self.sim.add_dft_fields(self.decay_fields,self.fcen,self.df,1,center=self.design_regions[0].center,size=mp.Vector3(1/self.sim.resolution))
-            self.sim.run(until_after_sources=stop_when_dft_decayed(mdft, self.decay_dt, self.decay_fields, self.fcen, self.decay_by))
-            
-            # record final objective function value
-            results_list = []
-            for m in self.objective_arguments:
-                results_list.append(m())
-            fm = self.objective_function(*results_list)
+            fm = self._evaluate_objective()
 
             # -------------------------------------------- #
             # right function evaluation
             # -------------------------------------------- #
-            self.sim.reset_meep()
-
-            # assign new design vector
-            b0[k] += 2*db # central difference rule...
+            b0 = np.copy(rho0)
+            b0[k] += db # central difference rule...
             self.basis[basis_idx].set_rho_vector(b0)
-
-            # initialize design monitors
-            for m in self.objective_arguments:
-                m.register_monitors(self.fcen,self.df,self.nf)
-            
-            # add monitor used to track dft convergence
-            mdft = self.sim.add_dft_fields(self.decay_fields,self.fcen,self.df,1,center=self.design_regions[0].center,size=mp.Vector3(1/self.sim.resolution))
-            self.sim.run(until_after_sources=stop_when_dft_decayed(mdft, self.decay_dt, self.decay_fields, self.fcen, self.decay_by))
-            
-            # record final objective function value
-            results_list = []
-            for m in self.objective_arguments:
-                results_list.append(m())
-            fp = self.objective_function(*results_list)
+            fp = self._evaluate_objective()
 
             # -------------------------------------------- #
             # estimate derivative
             # -------------------------------------------- #
             fd_gradient[k,:] = (fp - fm) / (2*db)
-        
+
+        # restore the unperturbed design
+        self.basis[basis_idx].set_rho_vector(rho0)
+
         return np.squeeze(fd_gradient), fd_gradient_idx
-    
+
+    def _stop_conditions(self, mdft):
+        '''
+        Conditions for terminating a run: the DFT fields in mdft have converged,
+        or (if maximum_run_time is set) that much simulation time has elapsed.
+        '''
+        conditions = [stop_when_dft_decayed(mdft, self.decay_dt, self.decay_fields, self.fcen, self.decay_by)]
+        if self.maximum_run_time is not None:
+            conditions.append(lambda sim: sim.round_time() >= self.maximum_run_time)
+        return conditions
+
+    def _evaluate_objective(self):
+        '''
+        Run a forward simulation for the current design and return the objective function value.
+
+        The mp.Simulation is reused, but reset_meep() discards its structure as
+        well as its fields, so set_epsilon re-samples the design on every call.
+        '''
+        self.sim.reset_meep()
+
+        # initialize design monitors
+        for m in self.objective_arguments:
+            m.register_monitors(self.fcen,self.df,self.nf)
+
+        # add monitor used to track dft convergence
+        mdft = self.sim.add_dft_fields(self.decay_fields,self.fcen,self.df,1,center=self.design_regions[0].center,size=mp.Vector3(1/self.sim.resolution))
+        self.sim.run(until_after_sources=self._stop_conditions(mdft))
+
+        # record final objective function value
+        results_list = []
+        for m in self.objective_arguments:
+            results_list.append(m())
+        return self.objective_function(*results_list)
+
     def update_design(self, rho_vector):
         """Update the design permittivity function.
 
@@ -312,6 +352,19 @@ class OptimizationProblem(object):
 
         self.sim.plot2D(**kwargs)
 
+def objective_jacobians(f, args):
+    '''
+    Jacobians of f with respect to each of its arguments, i.e. the list
+    [jacobian(f,i)(*args) for i in range(len(args))], computed from a single
+    autograd trace of f rather than one trace per argument.
+    '''
+    vjp, ans = make_vjp(f, tuple(range(len(args))))(*args)
+    ans = np.asarray(ans)
+    if ans.ndim == 0:
+        return list(vjp(np.ones_like(ans)))
+    rows = [vjp(e) for e in np.eye(ans.size).reshape((ans.size,)+ans.shape)]
+    return [np.stack([r[i] for r in rows]).reshape(ans.shape + np.shape(args[i])) for i in range(len(args))]
+
 def stop_when_dft_decayed(mon, dt, c, freq, decay_by):
     closure = {
         'previous_fields': np.array([1]*len(c)),
@@ -19,5 +19,8 @@ setup(name='meep_adjoint',
       install_requires=[
         'jax',
         'jaxlib'
-        ]
+        ],
+      extras_require={
+        'numba': ['numba']
+        },
       packages=['meep_adjoint'])
@@ -0,0 +1,73 @@
+import meep as mp
+import meep_adjoint as mpa
+import numpy as np
+import unittest
+
+class StubSimulation(object):
+    '''Just enough of mp.Simulation for calculate_fd_gradient to run without timestepping.'''
+    sources = []
+    def reset_meep(self):
+        pass
+    def change_sources(self, sources):
+        pass
+
+class TestFiniteDifferenceGradient(unittest.TestCase):
+    '''
+    Check calculate_fd_gradient against the analytic gradient of a quadratic
+    objective f(rho) = sum(a*rho**2) + dot(c,rho), substituted for the
+    forward simulation.
+    '''
+    def setUp(self):
+        Nx, Ny = 4, 4
+        rng = np.random.default_rng(0)
+        self.a, self.c = rng.uniform(1, 2, Nx*Ny), rng.uniform(-1, 1, Nx*Ny)
+        self.rho0 = rng.uniform(1, 12, Nx*Ny)
+
+        design_region = mp.Volume(center=mp.Vector3(), size=mp.Vector3(1, 1, 0))
+        self.basis = mpa.BilinearInterpolationBasis(volume=design_region,Nx=Nx,Ny=Ny,rho_vector=np.copy(self.rho0))
+        self.opt = mpa.OptimizationProblem(simulation=StubSimulation(),
+                                           objective_function=lambda x: np.sum(x),
+                                           objective_arguments=[None],
+                                           basis=[self.basis],
+                                           fcen=1/1.55)
+        rho = lambda: np.asarray(self.basis.rho_vector)
+        self.opt._evaluate_objective = lambda: np.sum(self.a*rho()**2) + np.dot(self.c, rho())
+        self.g_exact = 2*self.a*self.rho0 + self.c
+
+    def check(self, one_sided, db, tol):
+        idx = np.array([0, 5, 6, 15])
+        g, g_idx = self.opt.calculate_fd_gradient(db=db, one_sided=one_sided, fd_gradient_idx=idx)
+        np.testing.assert_array_equal(g_idx, idx)
+        np.testing.assert_allclose(g[idx], self.g_exact[idx], rtol=0, atol=tol)
+        # parameters that were not sampled are left at zero
+        self.assertTrue(np.all(np.delete(g, idx) == 0))
+        # the unperturbed design is restored
+        np.testing.assert_array_equal(self.basis.rho_vector, self.rho0)
+
+    def test_central_difference(self):
+        # exact for a quadratic, up to rounding
+        self.check(one_sided=False, db=1e-3, tol=1e-6)
+
+    def test_one_sided_difference(self):
+        # truncation error is a_k*db
+        db = 1e-4
+        self.check(one_sided=True, db=db, tol=2*db*self.a.max())
+
+    def test_one_sided_given_baseline(self):
+        # an explicit baseline replaces the baseline simulation
+        evaluate, calls = self.opt._evaluate_objective, []
+        self.opt._evaluate_objective = lambda: calls.append(1) or evaluate()
+        f0 = evaluate()
+        db, idx = 1e-4, np.array([1, 2, 3])
+        g, _ = self.opt.calculate_fd_gradient(db=db, one_sided=True, fd_gradient_idx=idx, f0=f0)
+        self.assertEqual(len(calls), len(idx))
+        np.testing.assert_allclose(g[idx], self.g_exact[idx], rtol=0, atol=2*db*self.a.max())
+
+    def test_random_indices(self):
+        g, idx = self.opt.calculate_fd_gradient(num_gradients=5, db=1e-3)
+        self.assertEqual(len(idx), 5)
+        np.testing.assert_allclose(g[idx], self.g_exact[idx], rtol=0, atol=1e-6)
+        np.testing.assert_array_equal(self.basis.rho_vector, self.rho0)
+
+if __name__ == '__main__':
+    unittest.main()
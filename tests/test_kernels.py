@@ -0,0 +1,60 @@
+import numpy as np
+import unittest
+
+from meep_adjoint import _kernels
+
+class TestReductionKernels(unittest.TestCase):
+    """Check the kernels against the direct numpy expressions they replace."""
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        M = 1000
+        cplx = lambda: np.ascontiguousarray(rng.standard_normal(M) + 1j*rng.standard_normal(M))
+        self.w = rng.random(M)
+        self.w.setflags(write=False)   # DFTCell weights are read-only
+        self.EH = [cplx() for _ in range(4)]
+        self.eh = [cplx() for _ in range(4)]
+        self.eps, self.mu = cplx(), cplx()
+
+    def implementations(self):
+        impls = [(_kernels._poynting_numpy, _kernels._overlap_numpy, _kernels._energy_numpy)]
+        if _kernels.HAVE_NUMBA:
+            impls.append((_kernels._poynting_numba, _kernels._overlap_numba, _kernels._energy_numba))
+        return impls
+
+    def test_poynting(self):
+        w, EH = self.w, self.EH
+        ref = np.real(np.sum(w*( np.conj(EH[0])*EH[3] - np.conj(EH[1])*EH[2]) ))
+        for poynting, _, _ in self.implementations():
+            self.assertAlmostEqual(poynting(w, *EH), ref, places=8)
+
+    def test_overlap(self):
+        w, EH, eh = self.w, self.EH, self.eh
+        eH = np.sum( w*(np.conj(eh[0])*EH[3] - np.conj(eh[1])*EH[2]) )
+        hE = np.sum( w*(np.conj(eh[3])*EH[0] - np.conj(eh[2])*EH[1]) )
+        for sign in [1.0, -1.0]:
+            ref = (eH + sign*hE)/4.0
+            for _, overlap, _ in self.implementations():
+                self.assertLess(abs(overlap(w, *eh, *EH, sign) - ref), 1e-8*abs(ref))
+
+    def test_energy(self):
+        w, EH = self.w, np.stack(self.EH)
+        e_idx, h_idx = np.array([0,1], dtype=np.intp), np.array([2,3], dtype=np.intp)
+        E2 = np.sum( [np.conj(EH[nc])*EH[nc] for nc in e_idx], axis=0 )
+        H2 = np.sum( [np.conj(EH[nc])*EH[nc] for nc in h_idx], axis=0 )
+        ref = 0.5*np.sum(w*self.eps*E2) + 0.5*np.sum(w*self.mu*H2)
+        for _, _, energy in self.implementations():
+            self.assertLess(abs(energy(w, self.eps, self.mu, EH, e_idx, h_idx) - ref), 1e-8*abs(ref))
+
+    @unittest.skipUnless(_kernels.HAVE_NUMBA, 'numba not installed')
+    def test_warmup_covers_dftcell_signatures(self):
+        w, EH = self.w, self.EH
+        idx = np.zeros(1, dtype=np.intp)
+        kernels = [_kernels.poynting, _kernels.overlap, _kernels.energy]
+        nsigs = [len(k.signatures) for k in kernels]
+        _kernels.poynting(w, *EH)
+        _kernels.overlap(w, *self.eh, *EH, 1.0)
+        _kernels.energy(w, self.eps, self.mu, np.stack(EH), idx, idx)
+        self.assertEqual([len(k.signatures) for k in kernels], nsigs)
+
+if __name__ == '__main__':
+    unittest.main()